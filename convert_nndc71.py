@@ -8,20 +8,41 @@ used for OpenMC's regression test suite.
 
 import argparse
 import glob
+import gzip
 import hashlib
+import mmap
+import os
 import shutil
 import subprocess
 import sys
 import tarfile
+import threading
 import zipfile
+from collections import Counter, defaultdict
+from concurrent.futures import (ProcessPoolExecutor, ThreadPoolExecutor,
+                                as_completed)
+from contextlib import contextmanager
+from fnmatch import fnmatchcase
+from multiprocessing import get_context
 from pathlib import Path
 from string import digits
+from urllib.parse import urlparse
+from urllib.request import Request, urlopen
 
+import h5py
 import openmc.data
-from openmc._utils import download
+
+try:
+    from isal import igzip
+except ImportError:
+    igzip = None
 
 # Make sure Python version is sufficient
-assert sys.version_info >= (3, 6), "Python 3.6+ is required"
+assert sys.version_info >= (3, 8), "Python 3.8+ is required"
+
+# Worker processes are started fresh, re-importing this script rather than
+# forking it, so everything that runs the conversion is under the main guard
+mp_context = get_context('spawn')
 
 
 class CustomFormatter(argparse.ArgumentDefaultsHelpFormatter,
@@ -41,17 +62,310 @@ parser.add_argument('--download', action='store_true',
 parser.add_argument('--no-download', dest='download', action='store_false',
                     help='Do not download tarball from NNDC-BNL')
 parser.add_argument('--extract', action='store_true',
-                    help='Extract compressed files')
+                    help='Extract compressed files that have not already been '
+                    'extracted')
 parser.add_argument('--no-extract', dest='extract', action='store_false',
                     help='Do not extract compressed file if it has already been extracted')
 parser.add_argument('--libver', choices=['earliest', 'latest'],
-                    default='earliest', help="Output HDF5 versioning. Use "
+                    default='latest', help="Output HDF5 versioning. Use "
                     "'earliest' for backwards compatibility or 'latest' for "
-                    "performance")
+                    "performance. Files written with 'latest' cannot be read "
+                    "by builds of OpenMC linked against HDF5 older than the "
+                    "version used to write them")
 parser.add_argument('-p', '--particles', choices=['neutron', 'photon'], nargs='+',
                     default=['neutron', 'photon'], help="Incident particles to include")
+parser.add_argument('--combine', action='store_true',
+                    help='Write a single HDF5 file for each type of data rather '
+                    'than one file per nuclide')
+parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+                    help='Number of worker processes used for conversion')
 parser.set_defaults(download=True, extract=True)
-args = parser.parse_args()
+
+
+def _md5_file(path, blocksize=1 << 20):
+    """Compute the MD5 checksum of a file, reading it in fixed-size blocks so
+    that memory usage does not grow with file size."""
+    md5 = hashlib.md5()
+    buf = bytearray(blocksize)
+    view = memoryview(buf)
+    with open(path, 'rb', buffering=0) as fh:
+        while True:
+            n = fh.readinto(buf)
+            if not n:
+                break
+            md5.update(view[:n])
+    return md5.hexdigest()
+
+
+def _find(root, pattern):
+    """Recursively find files under a directory whose names match a glob-style
+    pattern and return their paths in sorted order."""
+    paths = []
+    stack = [root]
+    while stack:
+        try:
+            entries = list(os.scandir(stack.pop()))
+        except FileNotFoundError:
+            continue
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                stack.append(entry.path)
+            elif fnmatchcase(entry.name, pattern) and \
+                    entry.is_file(follow_symlinks=False):
+                paths.append(Path(entry.path))
+    return sorted(paths)
+
+
+def _download(url, connections=8, blocksize=1 << 20):
+    """Download a file, using several concurrent HTTP range requests if the
+    server supports them, and return its MD5 checksum.
+
+    The checksum is computed as the data arrives, so the file does not need to
+    be read back from disk to verify it. If a file of the same size as the one
+    on the server already exists, the download is skipped and None is
+    returned.
+    """
+    f = Path(urlparse(url).path).name
+
+    # Data is written to a temporary file that is only renamed once complete,
+    # so that an interrupted download is never mistaken for a finished one
+    part = f + '.part'
+    md5 = hashlib.md5()
+
+    # Find the size of the file, making sure that range requests are honored
+    with urlopen(Request(url, headers={'Range': 'bytes=0-0'})) as response:
+        content_range = response.headers.get('Content-Range', '')
+        ranged = response.status == 206 and not content_range.endswith('/*')
+        if ranged:
+            size = int(content_range.rsplit('/', 1)[1])
+        else:
+            size = int(response.headers.get('Content-Length', -1))
+
+        if os.path.isfile(f) and os.path.getsize(f) == size:
+            print(f'Skipping {f}, already downloaded')
+            return None
+
+        print(f'Downloading {f}...')
+        if not ranged or size == 0 or not hasattr(os, 'pwrite'):
+            # Fall back to a single stream. If the server ignored the range,
+            # the response already contains the whole file.
+            if response.status != 200:
+                response.close()
+                response = urlopen(url)
+            with response, open(part, 'wb') as fh:
+                while True:
+                    chunk = response.read(blocksize)
+                    if not chunk:
+                        break
+                    fh.write(chunk)
+                    md5.update(chunk)
+            os.replace(part, f)
+            return md5.hexdigest()
+
+    step = -(-size // connections)
+    ranges = [(start, min(start + step, size) - 1)
+              for start in range(0, size, step)]
+
+    # Offset up to which each range has been written
+    written = [start for start, _ in ranges]
+    finished = [False]*len(ranges)
+    condition = threading.Condition()
+
+    def fetch_range(i, start, end):
+        try:
+            request = Request(url, headers={'Range': f'bytes={start}-{end}'})
+            with urlopen(request) as response:
+                if response.status != 206:
+                    raise IOError(f'Range request for {url} was not honored')
+                offset = start
+                while True:
+                    chunk = response.read(blocksize)
+                    if not chunk:
+                        break
+                    os.pwrite(fd, chunk, offset)
+                    offset += len(chunk)
+                    with condition:
+                        written[i] = offset
+                        condition.notify()
+            if offset != end + 1:
+                raise IOError(f'Incomplete download of {url}')
+        finally:
+            with condition:
+                finished[i] = True
+                condition.notify()
+
+    fd = os.open(part, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        if hasattr(os, 'posix_fallocate'):
+            os.posix_fallocate(fd, 0, size)
+        else:
+            os.ftruncate(fd, size)
+        with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+            futures = [executor.submit(fetch_range, i, *r)
+                       for i, r in enumerate(ranges)]
+
+            # MD5 has to be computed in order, so hash each range as it is
+            # written. The data just written is still in the page cache.
+            for i, (start, end) in enumerate(ranges):
+                offset = start
+                while offset <= end:
+                    with condition:
+                        condition.wait_for(
+                            lambda: written[i] > offset or finished[i])
+                        available = written[i]
+                    if available == offset:
+                        # Re-raise the error that stopped this range
+                        futures[i].result()
+                        raise IOError(f'Incomplete download of {url}')
+                    while offset < available:
+                        chunk = os.pread(fd, min(blocksize, available - offset),
+                                         offset)
+                        md5.update(chunk)
+                        offset += len(chunk)
+    finally:
+        os.close(fd)
+    os.replace(part, f)
+    return md5.hexdigest()
+
+
+@contextmanager
+def _decompressed(fh, compressed):
+    """Yield a stream of the decompressed contents of an open gzip file.
+
+    Decompression with zlib is single-threaded and dominates the time spent
+    extracting large tarballs, so pigz or ISA-L are used when available.
+    """
+    if not compressed:
+        yield fh
+        return
+
+    pigz = shutil.which('pigz')
+    if pigz is not None:
+        with subprocess.Popen([pigz, '-dc'], stdin=fh, stdout=subprocess.PIPE,
+                              bufsize=1 << 20) as proc:
+            yield proc.stdout
+            # Consume any trailing padding so that pigz exits cleanly
+            while proc.stdout.read(1 << 20):
+                pass
+        if proc.returncode != 0:
+            raise IOError(f'pigz failed to decompress {fh.name}')
+    elif igzip is not None:
+        with igzip.IGzipFile(fileobj=fh) as stream:
+            yield stream
+    else:
+        with gzip.GzipFile(fileobj=fh) as stream:
+            yield stream
+
+
+def _extract(archive_and_dir):
+    """Extract a zip file or tarball into the specified directory and return
+    the names of its members."""
+    f, extraction_dir = archive_and_dir
+    print('Extracting {}...'.format(f))
+    if f.endswith('.zip'):
+        with zipfile.ZipFile(f, 'r') as zipf:
+            zipf.extractall(extraction_dir)
+            return zipf.namelist()
+    else:
+        # Stream through the tarball with large read and copy buffers,
+        # extracting members as they are encountered. This avoids building an
+        # index of all members up front and lets decompression overlap with
+        # writing the extracted files.
+        compressed = f.endswith(('.tar.gz', '.tgz'))
+        names = []
+        with open(f, 'rb') as fh:
+            # The tarball is read strictly sequentially, so let the kernel read
+            # ahead aggressively and then drop it from the page cache afterward
+            fadvise = getattr(os, 'posix_fadvise', None)
+            if fadvise is not None:
+                fadvise(fh.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            with _decompressed(fh, compressed) as stream, \
+                    tarfile.open(fileobj=stream, mode='r|', bufsize=1 << 20,
+                                 copybufsize=1 << 20) as tgz:
+                for member in tgz:
+                    tgz.extract(member, extraction_dir)
+                    names.append(member.name)
+            if fadvise is not None:
+                fadvise(fh.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+        return names
+
+
+def _library_entry(h5_file, filetype, materials):
+    """Return the entry for an HDF5 file in the format used by
+    openmc.data.DataLibrary.register_file."""
+    return {'path': str(h5_file), 'type': filetype, 'materials': materials}
+
+
+class _AlignedFile(h5py.File):
+    """HDF5 file that, when newly created, aligns large datasets on page
+    boundaries so that they are written with large, aligned I/O."""
+
+    def __init__(self, name, mode='r', *args, **kwargs):
+        if mode == 'w':
+            kwargs.setdefault('alignment_threshold', 1 << 20)
+            kwargs.setdefault('alignment_interval', 4096)
+        super().__init__(name, mode, *args, **kwargs)
+
+
+# File alignment options require h5py 3.5+
+_alignment_supported = h5py.version.version_tuple >= (3, 5)
+
+
+def _init_worker():
+    """Initialize a worker process of the conversion pool."""
+    # export_to_hdf5 opens the output file itself, so substitute the file
+    # class it uses
+    if _alignment_supported:
+        h5py.File = _AlignedFile
+
+
+def _combine(entries, h5_file):
+    """Copy the data from several HDF5 files into a single file, removing the
+    original files, and return the library entry for the new file."""
+    materials = []
+    file_class = _AlignedFile if _alignment_supported else h5py.File
+    with file_class(h5_file, 'w', libver=args.libver) as dst:
+        for entry in entries:
+            with h5py.File(entry['path'], 'r') as src:
+                dst.attrs.update(src.attrs)
+                for name in src:
+                    # Copy at the HDF5 object level without decoding the data
+                    h5py.h5o.copy(src.id, name.encode(), dst.id, name.encode())
+                    materials.append(name)
+            os.remove(entry['path'])
+    return _library_entry(h5_file, entries[0]['type'], materials)
+
+
+def _convert_neutron(task):
+    """Convert an incident neutron or thermal scattering ACE file to HDF5 and
+    return the library entry for the resulting file.
+
+    Each worker writes its own HDF5 file and never touches the DataLibrary, so
+    no HDF5 file is shared between processes.
+    """
+    path, cls, destination, libver = task
+    print(f'Converting: {path.name}')
+    data = cls.from_ace(path)
+
+    # Export HDF5 file
+    h5_file = destination.joinpath('neutron', data.name + '.h5')
+    data.export_to_hdf5(h5_file, 'w', libver=libver)
+    filetype = 'thermal' if cls is openmc.data.ThermalScattering else 'neutron'
+    return _library_entry(h5_file, filetype, [data.name])
+
+
+def _convert_photon(task):
+    """Convert a pair of photoatomic/atomic relaxation ENDF files to HDF5 and
+    return the library entry for the resulting file."""
+    photo_path, atom_path, destination, libver = task
+    print('Converting:', photo_path.name, atom_path.name)
+    data = openmc.data.IncidentPhoton.from_endf(photo_path, atom_path)
+
+    # Export HDF5 file
+    h5_file = destination.joinpath('photon', data.name + '.h5')
+    data.export_to_hdf5(h5_file, 'w', libver=libver)
+    return _library_entry(h5_file, 'photon', [data.name])
+
 
 library_name = 'nndc'
 release = 'b7.1'
@@ -69,8 +383,8 @@ release_details = {
             'checksums': ['9729a17eb62b75f285d8a7628ace1449',
                           'e17d827c92940a30f22f096d910ea186'],
             'file_type': 'ace',
-            'ace_files': ace_files_dir.rglob('[aA-zZ]*.ace'),
-            'sab_files': ace_files_dir.rglob('*.acer'),
+            'ace_files': (ace_files_dir, '[A-Za-z]*.ace'),
+            'sab_files': (ace_files_dir, '*.acer'),
             'compressed_file_size': 497,
             'uncompressed_file_size': 1200
         },
@@ -79,8 +393,8 @@ release_details = {
             'compressed_files': ['ENDF-B-VII.1-photoat.zip',
                                  'ENDF-B-VII.1-atomic_relax.zip'],
             'file_type': 'endf',
-            'photo_files': endf_files_dir.joinpath('photoat').rglob('*.endf'),
-            'atom_files': endf_files_dir.joinpath('atomic_relax').rglob('*.endf'),
+            'photo_files': (endf_files_dir / 'photoat', '*.endf'),
+            'atom_files': (endf_files_dir / 'atomic_relax', '*.endf'),
             'compressed_file_size': 9,
             'uncompressed_file_size': 45
         }
@@ -101,109 +415,216 @@ for use with OpenMC. This data is used for OpenMC's regression test suite.
 """.format(compressed_file_size, uncompressed_file_size)
 
 
-# ==============================================================================
-# DOWNLOAD FILES FROM NNDC SITE
-
-if args.download:
-    print(download_warning)
-    for particle in args.particles:
-        for f in release_details[release][particle]['compressed_files']:
-            # Establish connection to URL
-            url = release_details[release][particle]['base_url'] + f
-            downloaded_file = download(url)
-
-# ==============================================================================
-# VERIFY MD5 CHECKSUMS
-
-if args.download:
-    print('Verifying MD5 checksums...')
-    for particle in args.particles:
-        if 'checksums' in release_details[release].keys():
-            for f, checksum in zip(release_details[release]['compressed_files'],
-                                   release_details[release]['checksums']):
-                downloadsum = hashlib.md5(open(f, 'rb').read()).hexdigest()
-            if downloadsum != checksum:
-                raise IOError("MD5 checksum for {} does not match. If this is your first "
-                              "time receiving this message, please re-run the script. "
-                              "Otherwise, please contact OpenMC developers by emailing "
-                              "openmc-users@googlegroups.com.".format(f))
-
-# ==============================================================================
-# EXTRACT FILES FROM TGZ
-
-if args.extract:
-    for particle in args.particles:
-        if release_details[release][particle]['file_type'] == 'ace':
-            extraction_dir = ace_files_dir
-        elif release_details[release][particle]['file_type'] == 'endf':
-            extraction_dir = endf_files_dir
-
-        for f in release_details[release][particle]['compressed_files']:
-            # Extract files
-
-            if f.endswith('.zip'):
-                with zipfile.ZipFile(f, 'r') as zipf:
-                    print('Extracting {}...'.format(f))
-                    zipf.extractall(extraction_dir)
-            else:
-                with tarfile.open(f, 'r') as tgz:
-                    print('Extracting {}...'.format(f))
-                    tgz.extractall(path=extraction_dir)
-
 # ==============================================================================
 # FIX ZAID ASSIGNMENTS FOR VARIOUS S(A,B) TABLES
 
-if 'neutron' in args.particles:
-    print('Fixing ZAIDs for S(a,b) tables')
+def _fix_zaids(names):
+    """Correct the ZAIDs listed in S(a,b) tables that are known to be wrong.
+
+    The fixes are not idempotent, so they are only applied to the tables among
+    the given names of freshly extracted files.
+    """
     fixes = [('bebeo.acer', '8016', '   0'),
              ('obeo.acer', '4009', '   0')]
+    names = {Path(name).name for name in names}
     for table, old, new in fixes:
+        if table not in names:
+            continue
+        print('Fixing ZAID for S(a,b) table {}'.format(table))
+
+        # Patch the first occurrence in place rather than rewriting the file
         filename = ace_files_dir / table
-        with open(filename, 'r') as fh:
-            text = fh.read()
-        text = text.replace(old, new, 1)
-        with open(filename, 'w') as fh:
-            fh.write(text)
+        with open(filename, 'r+b') as fh, \
+                mmap.mmap(fh.fileno(), 0) as mm:
+            i = mm.find(old.encode())
+            if i >= 0:
+                mm[i:i + len(old)] = new.encode()
+
 
 # ==============================================================================
-# GENERATE HDF5 LIBRARY
+# DOWNLOAD, VERIFY, AND EXTRACT A SINGLE COMPRESSED FILE
+
+def _fetch(url, f, checksum, extraction_dir, extractor):
+    """Download, verify, and extract a compressed file, as requested by the
+    command-line arguments.
+
+    Sentinel files record a verified checksum and a completed extraction so
+    that these steps can be skipped when the script is re-run. The checksum is
+    stored along with the size and modification time of the verified file so
+    that it no longer applies once the file is removed or replaced.
+    """
+    verified = Path(f + '.md5ok')
+    extracted = extraction_dir / ('.' + f + '.extracted')
+
+    up_to_date = False
+    if verified.is_file():
+        if checksum is not None and os.path.isfile(f):
+            stat = os.stat(f)
+            up_to_date = verified.read_text().split() == [
+                checksum, str(stat.st_size), str(stat.st_mtime_ns)]
+        if not up_to_date:
+            verified.unlink()
+
+    downloadsum = None
+    if args.download and not up_to_date:
+
+        # A file that already exists with the right size is not downloaded
+        # again, in which case no checksum is returned
+        downloadsum = _download(url)
+
+        # A new copy of the file has to be extracted again
+        if downloadsum is not None and extracted.exists():
+            extracted.unlink()
+
+    if (downloadsum is None and checksum is not None and not up_to_date
+            and (args.download or (args.extract and not extracted.exists()))):
+        # A file that was not just downloaded is read back to verify it.
+        # hashlib releases the GIL while hashing, so several files can be
+        # verified concurrently from separate threads.
+        print('Verifying MD5 checksum for {}...'.format(f))
+        downloadsum = _md5_file(f)
+
+    if checksum is not None and downloadsum is not None:
+        if downloadsum != checksum:
+            # Remove a bad download so that it is fetched again on re-run
+            if args.download:
+                os.remove(f)
+            raise IOError("MD5 checksum for {} does not match. If this is your first "
+                          "time receiving this message, please re-run the script. "
+                          "Otherwise, please contact OpenMC developers by emailing "
+                          "openmc-users@googlegroups.com.".format(f))
+        stat = os.stat(f)
+        verified.write_text(f'{checksum} {stat.st_size} {stat.st_mtime_ns}')
+
+    if args.extract and not extracted.exists():
+        # Extraction is done in a worker process
+        names = extractor.submit(_extract, (f, extraction_dir)).result()
+        if extraction_dir == ace_files_dir:
+            _fix_zaids(names)
+        extracted.touch()
 
-# Create output directory if it doesn't exist
-for particle in args.particles:
-    particle_destination = args.destination / particle
-    particle_destination.mkdir(parents=True, exist_ok=True)
 
-library = openmc.data.DataLibrary()
+# ==============================================================================
+# CONVERT ALL FILES FOR A PARTICLE TO HDF5
+
+def _convert(particle, pool):
+    """Submit conversion of all files for a particle to the pool and return an
+    iterator over the library entries for the resulting HDF5 files.
 
-for particle in args.particles:
+    Each task is dispatched on its own since conversion times vary widely
+    between nuclides.
+    """
     details = release_details[release][particle]
+
+    # Now that extraction is done, search the directories once
+    files = {key: _find(*details[key])
+             for key in ('ace_files', 'sab_files', 'photo_files', 'atom_files')
+             if key in details}
+
     if particle == 'neutron':
-        for cls, files in [(openmc.data.IncidentNeutron, 'ace_files'),
-                           (openmc.data.ThermalScattering, 'sab_files')]:
-            for path in sorted(details[files]):
-                print(f'Converting: {path.name}')
-                data = cls.from_ace(path)
-                # Export HDF5 file
-                h5_file = args.destination.joinpath(particle, data.name + '.h5')
-                data.export_to_hdf5(h5_file, 'w', libver=args.libver)
-
-                # Register with library
-                library.register_file(h5_file)
+        tasks = [(path, cls, args.destination, args.libver)
+                 for cls, key in [(openmc.data.IncidentNeutron, 'ace_files'),
+                                  (openmc.data.ThermalScattering, 'sab_files')]
+                 for path in files[key]]
+        return pool.imap_unordered(_convert_neutron, tasks, chunksize=1)
 
     elif particle == 'photon':
-        for photo_path, atom_path in zip(sorted(details['photo_files']),
-                                         sorted(details['atom_files'])):
-            # Generate instance of IncidentPhoton
-            print('Converting:', photo_path.name, atom_path.name)
-            data = openmc.data.IncidentPhoton.from_endf(photo_path, atom_path)
-
-            # Export HDF5 file
-            h5_file = args.destination.joinpath(particle, data.name + '.h5')
-            data.export_to_hdf5(h5_file, 'w', libver=args.libver)
-
-            # Register with library
-            library.register_file(h5_file)
-
-# Write cross_sections.xml
-print('Writing ', args.destination / 'cross_sections.xml')
-library.export_to_xml(args.destination / 'cross_sections.xml')
+        tasks = [(photo_path, atom_path, args.destination, args.libver)
+                 for photo_path, atom_path in zip(files['photo_files'],
+                                                  files['atom_files'])]
+        return pool.imap_unordered(_convert_photon, tasks, chunksize=1)
+
+
+# ==============================================================================
+# GENERATE HDF5 LIBRARY
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    if args.download:
+        print(download_warning)
+
+    # Create output directory if it doesn't exist
+    for particle in args.particles:
+        particle_destination = args.destination / particle
+        particle_destination.mkdir(parents=True, exist_ok=True)
+
+    library = openmc.data.DataLibrary()
+
+    # Workers are replaced periodically to bound the memory held by long-lived
+    # processes after converting many large nuclides. Since replacements are
+    # started while the fetch threads are running, they are spawned rather
+    # than forked; a forked child could inherit a lock held by another thread
+    # and deadlock.
+    with mp_context.Pool(args.jobs, initializer=_init_worker,
+                         maxtasksperchild=8) as pool:
+        # Each compressed file is downloaded, verified, and extracted
+        # independently so that network I/O for one file overlaps with
+        # processing of another
+        archives = []
+        for particle in args.particles:
+            details = release_details[release][particle]
+            if details['file_type'] == 'ace':
+                extraction_dir = ace_files_dir
+            elif details['file_type'] == 'endf':
+                extraction_dir = endf_files_dir
+
+            # Archives are extracted concurrently, so create the directory up
+            # front rather than racing to create it while extracting
+            extraction_dir.mkdir(parents=True, exist_ok=True)
+
+            checksums = details.get('checksums',
+                                    [None]*len(details['compressed_files']))
+            for f, checksum in zip(details['compressed_files'], checksums):
+                url = details['base_url'] + f
+                archives.append((particle, (url, f, checksum, extraction_dir)))
+
+        # Extraction has its own workers so that it never waits behind
+        # conversion tasks already queued for another particle
+        with ThreadPoolExecutor(max_workers=len(archives)) as executor, \
+                ProcessPoolExecutor(max_workers=len(archives),
+                                    mp_context=mp_context) as extractor:
+            futures = {executor.submit(_fetch, *fetch_args, extractor): particle
+                       for particle, fetch_args in archives}
+
+            # Start converting a particle as soon as all of its files are ready
+            remaining = Counter(futures.values())
+            results = []
+            for future in as_completed(futures):
+                future.result()
+                particle = futures[future]
+                remaining[particle] -= 1
+                if remaining[particle] == 0:
+                    results.append(_convert(particle, pool))
+
+        entries = [entry for r in results for entry in r]
+
+    entries.sort(key=lambda entry: entry['path'])
+
+    # Merge the per-nuclide files into one file for each type of data
+    if args.combine:
+        by_type = defaultdict(list)
+        for entry in entries:
+            by_type[entry['type']].append(entry)
+        entries = [_combine(group, args.destination / f'{filetype}.h5')
+                   for filetype, group in by_type.items()]
+
+        # Remove the per-particle directories that held the original files
+        for particle in args.particles:
+            particle_destination = args.destination / particle
+            if not any(particle_destination.iterdir()):
+                particle_destination.rmdir()
+
+    # Register with library in a deterministic order once all workers are
+    # done. The workers already know what each file contains, so the entries
+    # are added directly rather than through register_file, which would reopen
+    # every file. DataLibrary is itself a list of entries in newer versions of
+    # openmc, whereas older versions keep them in its libraries attribute.
+    if isinstance(library, list):
+        library.extend(entries)
+    else:
+        library.libraries.extend(entries)
+
+    # Write cross_sections.xml
+    print('Writing ', args.destination / 'cross_sections.xml')
+    library.export_to_xml(args.destination / 'cross_sections.xml')